@@ -1,9 +1,26 @@
 import streamlit as st
-import google.generativeai as genai
+import gzip
+import hashlib
+import json
+import logging
 import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from pathlib import Path
+
+if TYPE_CHECKING:
+    # Nur für Typannotationen; zur Laufzeit wird das SDK erst bei Bedarf importiert
+    import google.generativeai as genai
+
+# Diagnosemeldungen; auf DEBUG-Ebene, damit sie im Normalbetrieb nichts kosten
+logger = logging.getLogger(__name__)
 
 # --- Konfiguration ---
 st.set_page_config(
@@ -19,6 +36,11 @@ try:
     aws_secret_access_key = st.secrets["AWS_SECRET_ACCESS_KEY"]
     s3_bucket_name = st.secrets["S3_BUCKET_NAME"]
     aws_region = st.secrets.get("AWS_REGION", "us-east-1")  # Standardmäßig us-east-1, falls nicht angegeben
+    # Optionaler Ordner der Unterkapiteldateien im Bucket (z. B. "unterkapitel/"), damit S3
+    # nur diese Schlüssel auflistet; leer bedeutet den gesamten Bucket
+    s3_prefix = st.secrets.get("S3_PREFIX", "")
+    # Alle Unterkapitel beim Start parallel vorladen; bei sehr großen Buckets deaktivieren
+    s3_prefetch = st.secrets.get("S3_PREFETCH", True)
 
     # Vorhandensein prüfen
     if not gemini_api_key or not aws_access_key_id or not aws_secret_access_key or not s3_bucket_name:
@@ -32,38 +54,36 @@ except Exception as e:
     st.error(f"Ein Fehler ist beim Laden der Geheimnisse aufgetreten: {e}")
     st.stop()
 
-# Gemini konfigurieren
-try:
-    genai.configure(api_key=gemini_api_key)
-except Exception as e:
-    st.error(f"Fehler bei der Konfiguration von Google Generative AI: {e}")
-    st.stop()
+# Anzahl gleichzeitig aufgelisteter Unterordner im Bucket
+LISTING_THREADS = 8
+
+# Anzahl paralleler S3-Abrufe beim Vorladen der Unterkapitel
+PREFETCH_THREADS = 32
 
 # --- AWS S3 Client-Initialisierung (Zwischengespeichert) ---
 @st.cache_resource(show_spinner="Verbinde mit AWS S3...")
 def get_s3_client():
-    """Initialisiert und gibt einen S3-Client mit Anmeldeinformationen aus den Geheimnissen zurück."""
+    """
+    Initialisiert und gibt einen S3-Client mit Anmeldeinformationen aus den Geheimnissen zurück.
+    Der Bucket wird hier nicht geprüft; Fehler zeigen sich beim ersten Auflisten.
+    """
     try:
+        # Verbindungspool passend zum parallelen Vorladen, Keep-Alive und adaptive Wiederholungen
+        s3_config = Config(
+            max_pool_connections=PREFETCH_THREADS,
+            tcp_keepalive=True,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            user_agent_extra="lehrmittel-bot",
+        )
         s3_client = boto3.client(
             's3',
             aws_access_key_id=aws_access_key_id,
             aws_secret_access_key=aws_secret_access_key,
-            region_name=aws_region
+            region_name=aws_region,
+            config=s3_config
         )
-
-        # Verbindung testen, indem versucht wird, den Bucket abzurufen
-        s3_client.head_bucket(Bucket=s3_bucket_name)
-        print("Erfolgreich mit S3 verbunden.")
+        logger.debug("S3-Client erstellt.")
         return s3_client
-    except ClientError as e:
-        error_code = e.response.get('Error', {}).get('Code', 'Unknown')
-        if error_code == '404':
-            st.error(f"S3-Bucket '{s3_bucket_name}' nicht gefunden. Überprüfen Sie den Bucket-Namen.")
-        elif error_code == '403':
-            st.error(f"Zugriff auf S3-Bucket '{s3_bucket_name}' verweigert. Überprüfen Sie die IAM-Berechtigungen.")
-        else:
-            st.error(f"Fehler beim Verbinden mit S3: {e}")
-        return None
     except Exception as e:
         st.error(f"Fehler bei der Initialisierung des S3-Clients: {e}")
         return None
@@ -83,72 +103,316 @@ generation_config = {
 
 PLATZHALTER_AUSWAHL = "-- Unterkapitel auswählen --"
 
+# System-Prompt für LearnLM; {name} ist der Name des Unterkapitels, {content} sein Text
+SYSTEM_PROMPT_VORLAGE = """Du bist ein KI-gestützter Tutor auf Basis von LearnLM und hilfst einem Lernenden dabei, das Kapitel '{name}' aus dem Lehrmittel Allgemeinbildung zu verstehen.
+
+Dein Wissen ist AUSSCHLIESSLICH auf den folgenden Text beschränkt. Verwende KEINE externen Informationen und zitiere NIEMALS Textpassagen wortwörtlich – formuliere immer mit eigenen Worten um.
+
+--- START DES TEXTES ---
+{content}
+--- ENDE DES TEXTES ---
+
+Seitenzahlen stehen im Format **[seite: XXX]** im Text. Nutze sie strategisch:
+- Gib die relevante Seite an, wenn du ein Thema erklärst oder vertiefst
+- Motiviere den Lernenden, zuerst etwas zu lesen oder im Nachhinein nachzuschlagen („Lies zuerst S.220, dann beantworte die Frage“)
+
+Prinzipien der Lernwissenschaft:
+- **Aktives Lernen**: Stelle Fragen, rege zum Nachdenken und Mitmachen an
+- **Kognitive Entlastung**: Gib nur eine Information oder Aufgabe pro Antwort
+- **Neugier fördern**: Verwende Analogien, stelle interessante Fragen, verbinde Inhalte
+- **Anpassung**: Passe dein Vorgehen an das Niveau und Ziel des Lernenden an
+- **Metakognition**: Fördere Selbstreflexion und Lernbewusstsein
+
+Sprache: **ANTWORTE AUSSCHLIESSLICH AUF DEUTSCH**
+
+Der Lernende wurde bereits begrüßt und wählt einen der folgenden Lernmodi. Warte auf die Wahl und verhalte dich dann so:
+
+1. **📚 Frag mich ab**: Stelle 1 Frage pro Durchlauf, beginnend einfach, dann steigend. Bitte um Begründung der Antwort. Wenn korrekt: loben. Wenn falsch: behutsam zur richtigen Lösung führen. Nach 5 Fragen: Zusammenfassung oder Fortsetzung anbieten.
+2. **💡 Erkläre ein Konzept**: Frage zuerst, welches Konzept erklärt werden soll. Gib eine schrittweise Erklärung.
+3. **🔄 Verwende eine Analogie**: Wähle eine geeignete Stelle im Text aus und erkläre sie mithilfe eines kreativen, aber passenden Vergleichs.
+4. **🔍 Vertiefe ein Thema**: Stelle offene, leitende Fragen.
+5. **🧠 Reflektiere oder fasse zusammen**: Fasse in eigenen Worten zusammen, was besprochen wurde. Stelle Reflexionsfragen wie: „Was fiel dir leicht? Wo möchtest du noch mehr üben?“
+6. **🧩 Erstelle eine Konzeptkarte**: Bitte den Lernenden, 3–5 zentrale Ideen aus dem Kapitel zu nennen. Hilf, Zusammenhänge zu erkennen.
+
+Stil: Sei stets freundlich, unterstützend und geduldig. Fördere ein Gefühl von Fortschritt und Selbstwirksamkeit.
+"""
+
+# Begrüßung beim Laden eines Unterkapitels (entspricht den Lernmodi im System-Prompt)
+BEGRUESSUNG_VORLAGE = """Hallo! 👋 Ich bin dein KI-Tutor für das Kapitel **'{name}'** aus dem Lehrmittel Allgemeinbildung.
+
+Wie möchtest du lernen? Wähle einen der folgenden Lernmodi:
+
+1. 📚 **Frag mich ab** – Teste dein Wissen
+2. 💡 **Erkläre ein Konzept**
+3. 🔄 **Verwende eine Analogie**
+4. 🔍 **Vertiefe ein Thema**
+5. 🧠 **Reflektiere oder fasse zusammen**
+6. 🧩 **Erstelle eine Konzeptkarte**
+
+Schreib mir einfach die Nummer oder den Namen des Modus."""
+
+# Anzahl der zuletzt gesendeten Chatnachrichten, die immer angezeigt werden
+ANZAHL_SICHTBARE_NACHRICHTEN = 20
+
+# Maximale Anzahl der an das Modell gesendeten Verlaufseinträge (gerade Zahl, damit der
+# Modellverlauf weiterhin mit einer Benutzernachricht beginnt)
+MAX_VERLAUF_NACHRICHTEN = 40
+
+# Das angezeigte Protokoll wird beim Überschreiten von MAX_PROTOKOLL_NACHRICHTEN auf die
+# letzten BEHALTENE_PROTOKOLL_NACHRICHTEN gekürzt, damit nicht bei jeder Antwort gekürzt wird
+MAX_PROTOKOLL_NACHRICHTEN = 200
+BEHALTENE_PROTOKOLL_NACHRICHTEN = 150
+KUERZUNGS_HINWEIS = "*[Frühere Nachrichten wurden gekürzt]*"
+
+# Anzahl der Unterkapitel-Chats, die pro Sitzung für einen Wechsel zurück gemerkt werden
+MAX_GEMERKTE_CHATS = 4
+
+# Gestreamte Antworten werden gepuffert, bis diese Zeichenzahl oder Wartezeit (Sekunden) erreicht ist;
+# 150 ms fassen schwankende Chunk-Abstände zu gleichmäßigen UI-Aktualisierungen zusammen
+STREAM_PUFFER_ZEICHEN = 8192
+STREAM_PUFFER_SEKUNDEN = 0.15
+
+# Objektschlüssel im Format '[Ordner/]Haupt_Thema_Unterthema.txt'; Gruppe 1 ist der Anzeigename
+SUBCHAPTER_KEY_PATTERN = re.compile(r'(?:.*/)?[^/_]+_[^/_]+_([^/_]+)\.txt$')
+
+# Obergrenze der aufgelisteten Unterkapitel; danach wird die Auflistung abgebrochen
+MAX_UNTERKAPITEL = 1000
+
+# Gültigkeitsdauer (Sekunden) der zwischengespeicherten S3-Listen und -Inhalte
+S3_CACHE_TTL = 3600
+
+# Verzeichnis des dateibasierten Caches; überdauert Neustarts des Servers
+CACHE_VERZEICHNIS = Path.home() / ".streamlit" / "lehrmittel_cache"
+
+# --- Datei-Cache Hilfsfunktionen ---
+
+def get_cache_file_path(kind: str, *parts: str) -> Path:
+    """Gibt den Pfad einer Cache-Datei für die angegebenen Schlüsselteile zurück."""
+    digest = hashlib.sha256("/".join(parts).encode('utf-8')).hexdigest()
+    return CACHE_VERZEICHNIS / f"{kind}_{digest}.json"
+
+def read_cache_file(path: Path) -> dict | None:
+    """Liest einen Eintrag aus dem Datei-Cache; None, wenn er fehlt oder unlesbar ist."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_cache_file(path: Path, entry: dict) -> None:
+    """Schreibt einen Eintrag atomar in den Datei-Cache."""
+    tmp_path = None
+    try:
+        CACHE_VERZEICHNIS.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_VERZEICHNIS, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # Der Datei-Cache ist optional; ohne ihn wird einfach erneut von S3 geladen
+        logger.debug("Konnte '%s' nicht im Datei-Cache speichern: %s", path.name, e)
+        # Halb geschriebene temporäre Datei nicht im Cache-Verzeichnis zurücklassen
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+def read_cached_content(bucket_name: str, object_key: str) -> tuple[str, str] | None:
+    """Liest (ETag, Inhalt) eines S3-Objekts aus dem Datei-Cache, falls vorhanden."""
+    entry = read_cache_file(get_cache_file_path("content", bucket_name, object_key))
+    try:
+        return entry['etag'], entry['content']
+    except (TypeError, KeyError):
+        return None
+
+def write_cached_content(bucket_name: str, object_key: str, etag: str, content: str) -> None:
+    """Schreibt (ETag, Inhalt) eines S3-Objekts in den Datei-Cache."""
+    write_cache_file(get_cache_file_path("content", bucket_name, object_key), {"etag": etag, "content": content})
+
+def read_cached_subchapter_map(bucket_name: str, prefix: str) -> tuple[dict[str, str], bool] | None:
+    """
+    Liest die gespeicherte Unterkapitel-Karte und ob sie noch jünger als S3_CACHE_TTL ist.
+    None, wenn keine lesbare Karte vorhanden ist.
+    """
+    entry = read_cache_file(get_cache_file_path("subchapters", bucket_name, prefix))
+    try:
+        return entry['map'], time.time() - entry['created'] < S3_CACHE_TTL
+    except (TypeError, KeyError):
+        return None
+
+def write_cached_subchapter_map(bucket_name: str, prefix: str, subchapter_map: dict[str, str]) -> None:
+    """Speichert die Unterkapitel-Karte mit Zeitstempel im Datei-Cache."""
+    entry = {"created": time.time(), "map": subchapter_map}
+    write_cache_file(get_cache_file_path("subchapters", bucket_name, prefix), entry)
+
 # --- S3 Hilfsfunktionen (Zwischengespeichert) ---
 
-@st.cache_data(show_spinner="Verfügbare Unterkapitel auflisten...")
-def get_available_subchapters_from_s3(bucket_name: str, _client) -> dict[str, str]:
+def add_subchapter_keys(subchapter_map: dict[str, str], object_keys) -> bool:
+    """
+    Übernimmt alle Objektschlüssel, die dem Namensmuster entsprechen, in die Karte.
+    Enthält die Karte bereits MAX_UNTERKAPITEL Einträge, wird True zurückgegeben und die
+    restlichen Schlüssel (und damit weitere Seiten des Paginators) werden nicht mehr gelesen.
+    """
+    for object_key in object_keys:
+        if object_key is None:
+            # JMESPath-Suche über eine Seite ohne 'Contents'
+            continue
+        # Ordnerpräfix, Namensmuster und Endung in einem Durchgang prüfen
+        match = SUBCHAPTER_KEY_PATTERN.match(object_key)
+        if match:
+            if len(subchapter_map) >= MAX_UNTERKAPITEL:
+                return True
+            # Verwenden des vollständigen Objektschlüssels als Wert
+            subchapter_map[match.group(1)] = object_key
+        else:
+            logger.debug("Überspringe Objekt mit unerwartetem Namensformat: %s", object_key)
+    return False
+
+def list_subchapters_in_folder(bucket_name: str, folder_prefix: str, _client) -> tuple[dict[str, str], bool]:
     """
-    Listet Objekte im S3-Bucket auf, analysiert Namen, die dem Muster entsprechen,
-    und gibt ein Dictionary zurück, das {Anzeigename: Objektschlüssel} zuordnet.
+    Listet die Unterkapitel unterhalb eines Ordners (einschließlich Unterordnern) auf, höchstens
+    MAX_UNTERKAPITEL. Gibt die Karte und zurück, ob dabei Unterkapitel ausgelassen wurden.
     """
     subchapter_map = {}
-    try:
-        # Alle Objekte im Bucket auflisten
-        response = _client.list_objects_v2(Bucket=bucket_name)
-
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                object_key = obj['Key']
-                # Umgang mit potenzieller Ordnerstruktur im Objektschlüssel
-                filename = Path(object_key).name
-                stem = Path(filename).stem
-
-                parts = stem.split('_')
-                if len(parts) == 3 and filename.endswith(".txt"):
-                    main_chapter_str, topic_str, subchapter_str = parts
-                    display_name = subchapter_str
-                    # Verwenden des vollständigen Objektschlüssels als Wert
-                    subchapter_map[display_name] = object_key
-                else:
-                    print(f"Info: Überspringe Objekt mit unerwartetem Namensformat: {object_key}")
+    page_iterator = _client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=folder_prefix)
+    # Nur die Schlüssel der .txt-Objekte aus den Seiten übernehmen
+    truncated = add_subchapter_keys(subchapter_map, page_iterator.search("Contents[?ends_with(Key, '.txt')].Key"))
+    return subchapter_map, truncated
 
-        # Umgang mit Paginierung, falls mehr als 1000 Objekte vorhanden sind
-        while response.get('IsTruncated', False):
-            response = _client.list_objects_v2(
-                Bucket=bucket_name,
-                ContinuationToken=response['NextContinuationToken']
+def list_subchapters_from_s3(bucket_name: str, prefix: str, _client) -> dict[str, str]:
+    """
+    Listet Objekte unterhalb des Präfixes im S3-Bucket auf, analysiert Namen, die dem
+    Muster entsprechen, und gibt ein Dictionary zurück, das {Anzeigename: Objektschlüssel} zuordnet.
+    Unterordner werden parallel aufgelistet. Fehler werden als Ausnahme weitergegeben.
+    """
+    subchapter_map = {}
+    truncated = False
+    # Oberste Ebene mit Trennzeichen auflisten: liefert die direkt abgelegten Dateien
+    # und die Unterordner; der Paginator folgt den Fortsetzungstoken automatisch
+    paginator = _client.get_paginator('list_objects_v2')
+    folder_prefixes = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        # Auch nach Erreichen der Obergrenze weiterblättern, damit alle Unterordner erfasst werden
+        folder_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+        if add_subchapter_keys(subchapter_map, (obj['Key'] for obj in page.get('Contents', []))):
+            truncated = True
+
+    # Die Unterordner sind unabhängig voneinander und werden gleichzeitig aufgelistet
+    if folder_prefixes:
+        with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+            folder_maps = executor.map(
+                lambda folder_prefix: list_subchapters_in_folder(bucket_name, folder_prefix, _client),
+                folder_prefixes,
             )
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    object_key = obj['Key']
-                    filename = Path(object_key).name
-                    stem = Path(filename).stem
-
-                    parts = stem.split('_')
-                    if len(parts) == 3 and filename.endswith(".txt"):
-                        main_chapter_str, topic_str, subchapter_str = parts
-                        display_name = subchapter_str
-                        subchapter_map[display_name] = object_key
-                    else:
-                        print(f"Info: Überspringe Objekt mit unerwartetem Namensformat: {object_key}")
-
-    except ClientError as e:
-        st.error(f"Fehler beim Auflisten von Dateien im S3-Bucket '{bucket_name}': {e}")
-        return {}
+            # executor.map liefert in der Reihenfolge der Ordner, daher ist das Ergebnis
+            # unabhängig davon, welcher Ordner zuerst fertig wird
+            for folder_map, folder_truncated in folder_maps:
+                subchapter_map.update(folder_map)
+                truncated = truncated or folder_truncated
+
+    # Jede Auflistung ist für sich begrenzt und folgt der festen S3-Schlüsselreihenfolge;
+    # nach dem Zusammenführen reproduzierbar die alphabetisch ersten Unterkapitel behalten
+    if truncated or len(subchapter_map) > MAX_UNTERKAPITEL:
+        logger.warning("Obergrenze von %d Unterkapiteln überschritten; die Auflistung wurde gekürzt.", MAX_UNTERKAPITEL)
+        subchapter_map = {name: subchapter_map[name] for name in sorted(subchapter_map)[:MAX_UNTERKAPITEL]}
+
+    # Leere Ergebnisse nicht speichern, damit neu hochgeladene Dateien sofort erscheinen
+    if subchapter_map:
+        write_cached_subchapter_map(bucket_name, prefix, subchapter_map)
+    return subchapter_map
+
+def refresh_subchapter_map(bucket_name: str, prefix: str, _client) -> None:
+    """Aktualisiert die gespeicherte Unterkapitel-Karte im Hintergrund."""
+    try:
+        subchapter_map = list_subchapters_from_s3(bucket_name, prefix, _client)
+        logger.info("Unterkapitel-Karte im Hintergrund aktualisiert (%d Einträge).", len(subchapter_map))
+        if subchapter_map:
+            # Die veraltete Karte im Speicher verwerfen; der nächste Durchlauf liest die neue Datei
+            get_available_subchapters_from_s3.clear()
     except Exception as e:
-        st.error(f"Ein unerwarteter Fehler ist beim Auflisten von S3-Dateien aufgetreten: {e}")
-        return {}
+        # Die veraltete Karte bleibt bis zum nächsten Versuch gültig
+        logger.warning("Hintergrundaktualisierung der Unterkapitel-Karte fehlgeschlagen: %s", e)
+
+@st.cache_resource(ttl=S3_CACHE_TTL, show_spinner="Verfügbare Unterkapitel auflisten...")
+def get_available_subchapters_from_s3(bucket_name: str, prefix: str, prefetch: bool, _client) -> dict[str, str]:
+    """
+    Gibt die Unterkapitel-Karte {Anzeigename: Objektschlüssel} zurück. Das Ergebnis wird
+    von allen Sitzungen gemeinsam genutzt und darf nicht verändert werden. Mit prefetch
+    werden die Inhalte einmal pro neu geladener Karte im Hintergrund vorgeladen.
+    """
+    # Nach einem Neustart die gespeicherte Karte sofort verwenden; ist sie abgelaufen,
+    # wird sie im Hintergrund neu aufgelistet und danach sofort übernommen
+    cached = read_cached_subchapter_map(bucket_name, prefix)
+    if cached is not None:
+        subchapter_map, is_fresh = cached
+        if not is_fresh:
+            threading.Thread(
+                target=refresh_subchapter_map,
+                args=(bucket_name, prefix, _client),
+                name="subchapter-map-refresh",
+                daemon=True,
+            ).start()
+    else:
+        try:
+            subchapter_map = list_subchapters_from_s3(bucket_name, prefix, _client)
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code', 'Unknown')
+            if error_code == 'NoSuchBucket':
+                st.error(f"S3-Bucket '{bucket_name}' nicht gefunden. Überprüfen Sie den Bucket-Namen.")
+            elif error_code == 'AccessDenied':
+                st.error(f"Zugriff auf S3-Bucket '{bucket_name}' verweigert. Überprüfen Sie die IAM-Berechtigungen.")
+            else:
+                st.error(f"Fehler beim Auflisten von Dateien im S3-Bucket '{bucket_name}': {e}")
+            return {}
+        except Exception as e:
+            st.error(f"Ein unerwarteter Fehler ist beim Auflisten von S3-Dateien aufgetreten: {e}")
+            return {}
+
+    if prefetch and subchapter_map:
+        start_subchapter_prefetch(bucket_name, list(subchapter_map.values()), _client)
+    return subchapter_map
 
-    sorted_subchapter_map = dict(sorted(subchapter_map.items()))
-    return sorted_subchapter_map
+def download_subchapter_content_from_s3(bucket_name: str, object_key: str, _client) -> str:
+    """
+    Lädt den Inhalt eines bestimmten Objekts aus S3 und legt ihn im Datei-Cache ab. Eine dort
+    vorhandene Kopie wird verwendet, solange ihr ETag mit dem aktuellen Objekt übereinstimmt.
+    Fehler werden als Ausnahme weitergegeben.
+    """
+    cached = read_cached_content(bucket_name, object_key)
+    try:
+        # Bedingter Abruf: Ist die Kopie noch aktuell, antwortet S3 mit 304 ohne Inhalt
+        conditional_args = {'IfNoneMatch': cached[0]} if cached else {}
+        response = _client.get_object(Bucket=bucket_name, Key=object_key, **conditional_args)
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code', 'Unknown')
+        if cached and error_code in ('304', 'NotModified'):
+            return cached[1]
+        raise
+
+    body = response['Body'].read()
+    # Mit 'Content-Encoding: gzip' hochgeladene Dateien werden komprimiert übertragen
+    if response.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    content = body.decode('utf-8')
+    write_cached_content(bucket_name, object_key, response['ETag'], content)
+    return content
+
+# max_entries begrenzt den Speicherbedarf; die TTL bleibt, damit geänderte Dateien
+# spätestens nach S3_CACHE_TTL per bedingtem Abruf erneut geprüft werden
+@st.cache_data(ttl=S3_CACHE_TTL, max_entries=64, show_spinner=False)
+def fetch_subchapter_content_from_s3(bucket_name: str, object_key: str, _client) -> str:
+    """
+    Gibt den Inhalt eines Objekts zurück und hält die zuletzt gewählten Unterkapitel im
+    Speicher. Fehler werden als Ausnahme weitergegeben und daher nicht zwischengespeichert.
+    """
+    return download_subchapter_content_from_s3(bucket_name, object_key, _client)
 
-@st.cache_data(show_spinner="Lade Inhalt des Unterkapitels...")
 def load_subchapter_content_from_s3(bucket_name: str, object_key: str, _client) -> str | None:
-    """Lädt den Inhalt eines bestimmten Objekts aus S3."""
+    """Lädt den Inhalt eines bestimmten Objekts aus S3 und zeigt Fehler in der Oberfläche an."""
     try:
-        response = _client.get_object(Bucket=bucket_name, Key=object_key)
-        content = response['Body'].read().decode('utf-8')
-        return content
+        with st.spinner("Lade Inhalt des Unterkapitels..."):
+            return fetch_subchapter_content_from_s3(bucket_name, object_key, _client)
     except ClientError as e:
         error_code = e.response.get('Error', {}).get('Code', 'Unknown')
         if error_code == 'NoSuchKey':
@@ -162,27 +426,154 @@ def load_subchapter_content_from_s3(bucket_name: str, object_key: str, _client)
         st.error(f"Ein Fehler ist beim Lesen der Datei '{object_key}' aus S3 aufgetreten: {e}")
         return None
 
-def initialize_learnlm_model(system_prompt: str) -> genai.GenerativeModel | None:
-    """Initialisiert das GenerativeModel mit einer Systemanweisung."""
+def prefetch_subchapter_contents(bucket_name: str, object_keys: list[str], _client) -> int:
+    """
+    Lädt alle Unterkapitel parallel in den Datei-Cache, damit die erste Auswahl nur noch
+    einen bedingten Abruf ohne Datenübertragung braucht. Der Speicher-Cache wird dabei nicht
+    befüllt, damit das Vorladen die zuletzt gewählten Unterkapitel nicht verdrängt. Gibt die
+    Anzahl der erfolgreich geladenen Unterkapitel zurück.
+    """
+    def prefetch(object_key: str) -> bool:
+        try:
+            download_subchapter_content_from_s3(bucket_name, object_key, _client)
+            return True
+        except Exception as e:
+            # Fehler werden bei der eigentlichen Auswahl erneut versucht und dort angezeigt
+            logger.debug("Vorabladen von '%s' fehlgeschlagen: %s", object_key, e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=PREFETCH_THREADS) as executor:
+        loaded = sum(executor.map(prefetch, object_keys))
+    logger.debug("%d von %d Unterkapiteln vorgeladen.", loaded, len(object_keys))
+    return loaded
+
+def start_subchapter_prefetch(bucket_name: str, object_keys: list[str], _client) -> threading.Thread:
+    """
+    Startet das Vorladen in einem Hintergrund-Thread, damit die Seite nicht darauf warten muss.
+    Wird nur beim Laden einer neuen Karte aufgerufen, nicht bei jedem Durchlauf.
+    """
+    thread = threading.Thread(
+        target=prefetch_subchapter_contents,
+        args=(bucket_name, object_keys, _client),
+        name="subchapter-prefetch",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+def build_system_prompt(display_name: str, content: str) -> str:
+    """Erstellt den System-Prompt für das angegebene Unterkapitel."""
+    return SYSTEM_PROMPT_VORLAGE.format(name=display_name, content=content)
+
+# Gemini konfigurieren (einmal pro Prozess, der Client wird von allen Sitzungen geteilt)
+@st.cache_resource(show_spinner=False)
+def configure_genai(api_key: str) -> bool:
+    """Konfiguriert Google Generative AI einmalig für den gesamten Prozess."""
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return True
+
+@st.cache_resource(max_entries=16, show_spinner="Initialisiere LearnLM-Modell...")
+def get_learnlm_model(prompt_digest: str, _system_prompt: str) -> "genai.GenerativeModel":
+    """
+    Erstellt das GenerativeModel für einen System-Prompt. Zwischengespeichert wird über den
+    Hash des Prompts; der Prompt selbst wird von Streamlit nicht gehasht.
+    """
+    import google.generativeai as genai
+
+    return genai.GenerativeModel(
+        model_name="learnlm-2.0-flash-experimental",
+        generation_config=generation_config,
+        system_instruction=_system_prompt,
+    )
+
+def get_prompt_digest(system_prompt: str) -> str:
+    """Gibt einen kurzen, stabilen Hash des System-Prompts zurück."""
+    return hashlib.blake2b(system_prompt.encode('utf-8'), digest_size=16).hexdigest()
+
+def get_content_digest(display_name: str, content: str) -> str:
+    """Gibt einen kurzen Hash von Name und Inhalt eines Unterkapitels zurück (ohne den Prompt zu erstellen)."""
+    return hashlib.blake2b(f"{display_name}\0{content}".encode('utf-8'), digest_size=16).hexdigest()
+
+def initialize_learnlm_model(system_prompt: str) -> "genai.GenerativeModel | None":
+    """Gibt das zwischengespeicherte Modell für den System-Prompt zurück."""
     try:
-        model = genai.GenerativeModel(
-            model_name="learnlm-2.0-flash-experimental",
-            generation_config=generation_config,
-            system_instruction=system_prompt,
-        )
-        return model
+        configure_genai(gemini_api_key)
+    except Exception as e:
+        st.error(f"Fehler bei der Konfiguration von Google Generative AI: {e}")
+        return None
+
+    try:
+        return get_learnlm_model(get_prompt_digest(system_prompt), system_prompt)
     except Exception as e:
         st.error(f"Fehler bei der Initialisierung des LearnLM-Modells: {e}")
         return None
 
+def buffer_response_text(response_stream, max_chars: int = STREAM_PUFFER_ZEICHEN, max_delay: float = STREAM_PUFFER_SEKUNDEN):
+    """
+    Fasst gestreamte Antwortteile zusammen und gibt sie erst weiter, wenn max_chars Zeichen
+    oder max_delay Sekunden erreicht sind. Das verringert die Anzahl der UI-Aktualisierungen.
+    """
+    buffer = []
+    buffered_chars = 0
+    last_flush = time.monotonic()
+    for chunk in response_stream:
+        buffer.append(chunk.text)
+        buffered_chars += len(chunk.text)
+        if buffered_chars >= max_chars or time.monotonic() - last_flush >= max_delay:
+            yield "".join(buffer)
+            buffer.clear()
+            buffered_chars = 0
+            last_flush = time.monotonic()
+    if buffer:
+        yield "".join(buffer)
+
 # --- Reset-Funktion ---
 def reset_chat_state():
     """Löscht den Chatverlauf und verwandte Sitzungszustandsvariablen."""
     st.session_state.messages = []
     st.session_state.learnlm_model = None
     st.session_state.chat_session = None
-    st.session_state.subchapter_content = None
-    print("Chat-Status zurückgesetzt.")
+    logger.debug("Chat-Status zurückgesetzt.")
+
+def remember_chat_state(content_digest: str):
+    """
+    Merkt sich Modell, Chat-Sitzung und Verlauf des aktuellen Unterkapitels für diese Sitzung.
+    Sind mehr als MAX_GEMERKTE_CHATS gemerkt, wird der am längsten nicht genutzte verworfen.
+    """
+    chat_sessions = st.session_state.chat_sessions
+    chat_sessions[content_digest] = {
+        "learnlm_model": st.session_state.learnlm_model,
+        "chat_session": st.session_state.chat_session,
+        "messages": st.session_state.messages,
+    }
+    # Dictionaries behalten die Einfügereihenfolge; der erste Eintrag ist der älteste
+    while len(chat_sessions) > MAX_GEMERKTE_CHATS:
+        del chat_sessions[next(iter(chat_sessions))]
+
+def restore_chat_state(content_digest: str) -> bool:
+    """Stellt einen gemerkten Chat wieder her; gibt False zurück, wenn keiner vorhanden ist."""
+    stored = st.session_state.chat_sessions.pop(content_digest, None)
+    if stored is None:
+        return False
+    # Als zuletzt genutzt wieder ans Ende stellen
+    st.session_state.chat_sessions[content_digest] = stored
+    st.session_state.learnlm_model = stored["learnlm_model"]
+    st.session_state.chat_session = stored["chat_session"]
+    st.session_state.messages = stored["messages"]
+    return True
+
+def apply_history_window():
+    """Begrenzt das angezeigte Protokoll und den an das Modell gesendeten Verlauf."""
+    messages = st.session_state.messages
+    if len(messages) > MAX_PROTOKOLL_NACHRICHTEN:
+        # Die Liste wird in place gekürzt, da sie auch in chat_sessions referenziert wird
+        messages[:] = [{"role": "assistant", "content": KUERZUNGS_HINWEIS}, *messages[-BEHALTENE_PROTOKOLL_NACHRICHTEN:]]
+    chat_session = st.session_state.chat_session
+    if chat_session is not None and len(chat_session.history) > MAX_VERLAUF_NACHRICHTEN:
+        # Der System-Prompt mit dem Kapiteltext bleibt erhalten; nur alte Fragen/Antworten entfallen
+        chat_session.history = chat_session.history[-MAX_VERLAUF_NACHRICHTEN:]
 
 # --- Streamlit App UI und Logik ---
 
@@ -190,34 +581,37 @@ st.title("📚 Lernen mit LearnLM")
 st.caption("Betrieben mit Google LearnLM 1.5 Pro Experimental")
 
 # --- Zustandsinitialisierung ---
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "selected_subchapter_display_name" not in st.session_state:
-    st.session_state.selected_subchapter_display_name = PLATZHALTER_AUSWAHL
-if "subchapter_content" not in st.session_state:
-    st.session_state.subchapter_content = None
-if "learnlm_model" not in st.session_state:
-    st.session_state.learnlm_model = None
-if "chat_session" not in st.session_state:
-    st.session_state.chat_session = None
-if "subchapter_map" not in st.session_state:
-    # Karte mit der S3-Funktion und dem zwischengespeicherten Client laden
-    st.session_state.subchapter_map = get_available_subchapters_from_s3(s3_bucket_name, s3_client)
+# Das Skript wird bei jedem Durchlauf neu ausgeführt, daher erhält jede Sitzung eigene Standardobjekte
+SITZUNG_STANDARDWERTE = {
+    "messages": [],
+    "selected_subchapter_display_name": PLATZHALTER_AUSWAHL,
+    "learnlm_model": None,
+    "chat_session": None,
+    # Chats bereits besuchter Unterkapitel, nach Hash von Name und Inhalt (get_content_digest)
+    "chat_sessions": {},
+}
+for key, default in SITZUNG_STANDARDWERTE.items():
+    st.session_state.setdefault(key, default)
+
+# Karte prozessweit zwischengespeichert laden (gemeinsam für alle Sitzungen)
+subchapter_map = get_available_subchapters_from_s3(s3_bucket_name, s3_prefix, s3_prefetch, s3_client)
 
 # --- Unterkapitelauswahl ---
-if not st.session_state.subchapter_map:
+if not subchapter_map:
     st.warning(
         f"Keine gültigen Unterkapiteldateien im S3-Bucket '{s3_bucket_name}' gefunden oder das Auflisten ist fehlgeschlagen. "
         f"Stellen Sie sicher, dass Dateien vorhanden sind und das Format 'Haupt_Thema_Unterthema.txt' befolgen, und überprüfen Sie die Berechtigungen."
     )
 
-# Optionen vorbereiten, einschließlich des Platzhalters
-available_display_names = [PLATZHALTER_AUSWAHL] + list(st.session_state.subchapter_map.keys())
+# Optionen einschließlich des Platzhalters nur neu aufbauen, wenn eine neue Karte geladen
+# wurde (nach Ablauf der TTL oder einer Hintergrundaktualisierung)
+if st.session_state.get("display_map") is not subchapter_map:
+    st.session_state.display_map = subchapter_map
+    st.session_state.display_names = [PLATZHALTER_AUSWAHL, *sorted(subchapter_map)]
+    st.session_state.display_index = {name: i for i, name in enumerate(st.session_state.display_names)}
+available_display_names = st.session_state.display_names
 
-try:
-    current_index = available_display_names.index(st.session_state.selected_subchapter_display_name)
-except ValueError:
-    current_index = 0
+current_index = st.session_state.display_index.get(st.session_state.selected_subchapter_display_name, 0)
 
 previous_selection = st.session_state.selected_subchapter_display_name
 
@@ -229,112 +623,57 @@ selected_display_name = st.selectbox(
 )
 
 # --- Unterkapitel laden und Modell/Chat initialisieren ---
+# Der Sitzungszustand wird vor dem Chat-Verlauf unten aktualisiert, daher ist kein st.rerun() nötig
 if selected_display_name != previous_selection:
     st.session_state.selected_subchapter_display_name = selected_display_name
 
     if selected_display_name == PLATZHALTER_AUSWAHL:
+        # Der Hinweis zur Auswahl erscheint unten im leeren Chat-Bereich
         reset_chat_state()
-        st.info("Bitte wählen Sie ein Unterkapitel aus der Liste, um zu beginnen.")
-        st.rerun()  # Sicherstellen, dass die UI nach dem Zurücksetzen vollständig aktualisiert wird
 
     else:
-        st.info(f"Lade Unterkapitel: {selected_display_name} von S3...")
+        # Ladehinweis in einem Platzhalter, da ohne st.rerun() nichts ihn entfernen würde
+        lade_hinweis = st.empty()
+        lade_hinweis.info(f"Lade Unterkapitel: {selected_display_name} von S3...")
         reset_chat_state()
 
         # Den entsprechenden Objektschlüssel abrufen
-        object_key_to_load = st.session_state.subchapter_map.get(selected_display_name)
+        object_key_to_load = subchapter_map.get(selected_display_name)
 
         if object_key_to_load:
             # Inhalt mit der S3-Funktion und dem zwischengespeicherten Client laden
             content = load_subchapter_content_from_s3(s3_bucket_name, object_key_to_load, s3_client)
 
             if content:  # Prüfen, ob das Laden des Inhalts erfolgreich war
-                st.session_state.subchapter_content = content
-
-                # Den System-Prompt definieren
-                system_prompt = f"""Du bist ein KI-gestützter Tutor auf Basis von LearnLM und hilfst einem Lernenden dabei, den Inhalt des folgenden Kapitels aus dem Lehrmittel Allgemeinbildung zu verstehen.
-
-                    Dein Wissen ist AUSSCHLIESSLICH auf den folgenden Text zum Kapitel '{selected_display_name}' beschränkt. Verwende KEINE externen Informationen und zitiere NIEMALS Textpassagen wortwörtlich – formuliere immer mit eigenen Worten um.
-
-                    --- START DES TEXTES ZUM KAPITEL '{selected_display_name}' ---
-                    {st.session_state.subchapter_content}
-                    --- ENDE DES TEXTES ZUM KAPITEL '{selected_display_name}' ---
-
-                    Wichtige Informationen zum Text:
-                    - Das Lehrmittel heißt **"Lehrmittel Allgemeinbildung"**
-                    - Seitenzahlen sind im Format **[seite: XXX]** im Text enthalten
-                    - Verwende Seitenzahlen strategisch:
-                    - Gib die relevante Seite an, wenn du ein Thema erklärst oder ein Konzept vertiefst
-                    - Nutze Seitenzahlen, um den Lernenden zu motivieren zuerst etwas zu lesen oder im Nachhinein nachzuschlagen
-                    - Nutze Seitenverweise als Lernstrategie („Lies zuerst S.220, dann beantworte die Frage“ oder „Versuche die Frage zu beantworten, danach lies auf S.223 nach“)
-
-                    Du arbeitest mit folgenden Prinzipien der Lernwissenschaft:
-                    - **Aktives Lernen**: Stelle Fragen, rege zum Nachdenken und Mitmachen an
-                    - **Kognitive Entlastung**: Gib nur eine Information oder Aufgabe pro Antwort
-                    - **Neugier fördern**: Verwende Analogien, stelle interessante Fragen, verbinde Inhalte
-                    - **Anpassung**: Passe dein Vorgehen an das Niveau und Ziel des Lernenden an
-                    - **Metakognition**: Fördere Selbstreflexion und Lernbewusstsein
-
-                    Sprache: **ANTWORTE AUSSCHLIESSLICH AUF DEUTSCH**
-
-                    Beginne das Gespräch mit einer freundlichen Begrüßung und biete folgende Lernmodi an:
-
-                    1. 📚 **Frag mich ab** – Teste mein Wissen
-                    2. 💡 **Erkläre ein Konzept**
-                    3. 🔄 **Verwende eine Analogie**
-                    4. 🔍 **Vertiefe ein Thema**
-                    5. 🧠 **Reflektiere oder fasse zusammen**
-                    6. 🧩 **Erstelle eine Konzeptkarte**
-
-                    Warte, bis sich der Lernende für einen Modus entscheidet.
-
-                    Spezifisches Verhalten je nach Modus:
+                # Gemerkte Chats über Name und Inhalt finden, damit der Prompt mit dem
+                # gesamten Kapiteltext nur bei einem neuen Chat erstellt wird
+                content_digest = get_content_digest(selected_display_name, content)
 
-                    - **📚 Frag mich ab**: Stelle 1 Frage pro Durchlauf, beginnend einfach, dann steigend. Bitte um Begründung der Antwort. Wenn korrekt: loben. Wenn falsch: behutsam zur richtigen Lösung führen. Nach 5 Fragen: Zusammenfassung oder Fortsetzung anbieten. Verwende relevante Seitenangaben bei Bedarf (z. B. „Diese Info findest du auf Seite 221“).
-
-                    - **💡 Erkläre ein Konzept**: Frage zuerst, welches Konzept erklärt werden soll. Gib eine schrittweise Erklärung. Biete relevante Seitenangaben zum Nachlesen an.
-
-                    - **🔄 Verwende eine Analogie**: Wähle eine geeignete Stelle im Text aus und erkläre sie mithilfe eines kreativen, aber passenden Vergleichs. Nutze Seitenangaben zur Orientierung.
-
-                    - **🔍 Vertiefe ein Thema**: Wenn der Lernende tiefer verstehen möchte, stelle offene, leitende Fragen. Nutze Seitenangaben zur Vertiefung.
-
-                    - **🧠 Reflektiere oder fasse zusammen**: Fasse in eigenen Worten zusammen, was besprochen wurde. Stelle Reflexionsfragen wie: „Was fiel dir leicht? Wo möchtest du noch mehr üben?“ Gib ggf. Hinweise auf Seiten zum Wiederholen.
-
-                    - **🧩 Konzeptkarte erstellen**: Bitte den Lernenden, 3–5 zentrale Ideen aus dem Kapitel zu nennen. Hilf, Zusammenhänge zu erkennen. Nutze Seitenzahlen zur Verankerung im Text.
-
-                    Stil: Sei stets freundlich, unterstützend und geduldig. Stelle pro Antwort nur eine Frage oder Information. Fördere ein Gefühl von Fortschritt und Selbstwirksamkeit.
-
-                    Bereit, mit dem Kapitel '{selected_display_name}' aus dem Lehrmittel Allgemeinbildung zu starten? Bitte den Lernenden, einen der 6 Lernmodi auszuwählen.
-                    """
-
-
-                # Das Modell initialisieren
-                st.session_state.learnlm_model = initialize_learnlm_model(system_prompt)
+                if restore_chat_state(content_digest):
+                    # In dieser Sitzung bereits besucht: Modell, Chat und Verlauf weiterverwenden
+                    st.success(f"Unterkapitel '{selected_display_name}' fortgesetzt. Ihr bisheriger Chat ist wiederhergestellt.")
+                else:
+                    # Das Modell initialisieren (pro System-Prompt zwischengespeichert)
+                    system_prompt = build_system_prompt(selected_display_name, content)
+                    st.session_state.learnlm_model = initialize_learnlm_model(system_prompt)
 
-                if st.session_state.learnlm_model:
-                    # Chat-Sitzung starten
-                    try:
-                        st.session_state.chat_session = st.session_state.learnlm_model.start_chat(history=[])
-                        st.success(f"Unterkapitel '{selected_display_name}' von S3 geladen. Fragen Sie mich alles dazu!")
-                        # Optionale anfängliche Begrüßung
+                    if st.session_state.learnlm_model:
+                        # Chat-Sitzung starten
                         try:
-                            initial_user_message = f"Bitte stell dich vor..."
-                            initial_response = st.session_state.chat_session.send_message(initial_user_message)
-                            st.session_state.messages.append({"role": "assistant", "content": initial_response.text})
-                        except Exception as e:
-                            st.warning(f"Konnte keine anfängliche Begrüßung von LearnLM erhalten: {e}")
-                            st.session_state.messages.append({"role": "assistant", "content": f"Hallo! Ich bin bereit, Ihnen beim Verständnis der Konzepte in '{selected_display_name}' zu helfen. Fragen Sie mich gerne alles zu diesem Unterkapitel."})
+                            st.session_state.chat_session = st.session_state.learnlm_model.start_chat(history=[])
+                            st.success(f"Unterkapitel '{selected_display_name}' von S3 geladen. Fragen Sie mich alles dazu!")
+                            # Feste Begrüßung anzeigen, statt sie per LLM-Anfrage erzeugen zu lassen
+                            st.session_state.messages.append({"role": "assistant", "content": BEGRUESSUNG_VORLAGE.format(name=selected_display_name)})
+                            remember_chat_state(content_digest)
 
-                        st.rerun()  # Erneut ausführen, um Erfolg/initiale Nachricht anzuzeigen
-
-                    except Exception as e:
-                        st.error(f"Fehler beim Starten der Chat-Sitzung: {e}")
+                        except Exception as e:
+                            st.error(f"Fehler beim Starten der Chat-Sitzung: {e}")
+                            reset_chat_state()
+                            st.session_state.selected_subchapter_display_name = PLATZHALTER_AUSWAHL
+                    else:
+                        st.error("Fehler bei der Initialisierung des LearnLM-Modells nach dem Laden des Inhalts.")
                         reset_chat_state()
                         st.session_state.selected_subchapter_display_name = PLATZHALTER_AUSWAHL
-                else:
-                    st.error("Fehler bei der Initialisierung des LearnLM-Modells nach dem Laden des Inhalts.")
-                    reset_chat_state()
-                    st.session_state.selected_subchapter_display_name = PLATZHALTER_AUSWAHL
             else:
                 # Laden des Inhalts von S3 fehlgeschlagen (Fehler in der Ladefunktion angezeigt)
                 reset_chat_state()
@@ -344,6 +683,8 @@ if selected_display_name != previous_selection:
             reset_chat_state()
             st.session_state.selected_subchapter_display_name = PLATZHALTER_AUSWAHL
 
+        lade_hinweis.empty()
+
 # --- Chat-Verlauf anzeigen ---
 st.markdown("---")
 current_topic = st.session_state.selected_subchapter_display_name \
@@ -352,7 +693,14 @@ current_topic = st.session_state.selected_subchapter_display_name \
 st.subheader(f"Chat über: {current_topic}")
 
 if st.session_state.selected_subchapter_display_name != PLATZHALTER_AUSWAHL and st.session_state.chat_session:
-    for message in st.session_state.messages:
+    older_messages = st.session_state.messages[:-ANZAHL_SICHTBARE_NACHRICHTEN]
+    recent_messages = st.session_state.messages[-ANZAHL_SICHTBARE_NACHRICHTEN:]
+    # Ältere Nachrichten nur auf Wunsch rendern, damit lange Verläufe nicht jeden Durchlauf verlangsamen
+    if older_messages and st.toggle(f"Frühere Nachrichten anzeigen ({len(older_messages)})", key="show_older_messages"):
+        for message in older_messages:
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+    for message in recent_messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 elif st.session_state.selected_subchapter_display_name == PLATZHALTER_AUSWAHL and not st.session_state.messages:
@@ -373,17 +721,29 @@ if user_prompt:
     with st.chat_message("user"):
         st.markdown(user_prompt)
 
+    chat_session = st.session_state.chat_session
+    history_before = None
     try:
-        with st.spinner("Denke nach..."):
-            response = st.session_state.chat_session.send_message(user_prompt)
-        assistant_response = response.text
+        # Beim Streamen merkt sich die Chat-Sitzung die Anfrage vor dem Lesen der Antwort;
+        # bricht der Stream ab, wird der vorherige Verlauf wiederhergestellt
+        history_before = list(chat_session.history)
+        with st.chat_message("assistant"):
+            with st.spinner("Denke nach..."):
+                response_stream = chat_session.send_message(user_prompt, stream=True)
+            # Antwort schrittweise anzeigen, während sie generiert wird
+            assistant_response = st.write_stream(buffer_response_text(response_stream))
+        # Liest den Verlauf und löst bei einer wegen SAFETY oder RECITATION abgebrochenen
+        # Antwort aus, bevor diese ins Protokoll übernommen wird
+        apply_history_window()
+        # Bereits direkt angezeigt, daher ist kein erneutes Ausführen nötig
         st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-        # Hier ist kein chat_message-Kontext erforderlich, nur anhängen und erneut ausführen
-
-        st.rerun()  # Erneut ausführen, um die neuen Nachrichten anzuzeigen
 
     except Exception as e:
+        # Der Setter verwirft auch die unvollständige Antwort, sonst schlagen alle weiteren Anfragen fehl
+        if history_before is not None:
+            chat_session.history = history_before
         st.error(f"Ein Fehler ist bei der Kommunikation mit LearnLM aufgetreten: {e}")
         error_message = f"Entschuldigung, ich bin auf einen Fehler gestoßen: {e}"
         st.session_state.messages.append({"role": "assistant", "content": error_message})
-        st.rerun()  # Erneut ausführen, um die Fehlermeldung anzuzeigen
+        with st.chat_message("assistant"):
+            st.markdown(error_message)